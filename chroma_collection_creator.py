@@ -1,9 +1,13 @@
 from langchain_community.vectorstores import Chroma
-from langchain.text_splitter import CharacterTextSplitter
+from google.api_core.exceptions import GoogleAPIError
+from chromadb.utils.batch_utils import create_batches
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
-from embedding_client import EmbeddingClient
+from embedding_client import EmbeddingClient, CachedEmbeddings
 from document_processor import DocumentProcessor
 from dotenv import load_dotenv
+import hashlib
+import numpy as np
 import sys
 import os
 import streamlit as st
@@ -11,6 +15,126 @@ sys.path.append(os.path.abspath('../../'))
 
 load_dotenv()
 
+# Directory where Chroma collections are persisted so documents are only embedded once
+CHROMA_PERSIST_DIRECTORY = ".chroma_cache"
+
+# Collection metadata key set once every chunk of a persisted collection has been written
+COLLECTION_COMPLETE_KEY = "quiz_complete"
+
+# Chunking settings; SPLITTER_VERSION must change whenever the way pages are split changes
+# 250 approximate tokens is about 1000 characters, the size of the previous character based chunks
+CHUNK_SIZE = 250
+CHUNK_OVERLAP = 25
+SPLITTER_VERSION = "recursive-tokens-v2"
+
+# Number of quantized embeddings converted back to float32 at a time while scoring a query
+QUERY_BLOCK_ROWS = 4096
+
+# Number of embeddings read from Chroma at a time while building the quantized query index
+INDEX_LOAD_PAGE_SIZE = 1000
+
+
+def hash_pages(pages, model_name):
+    """
+    Computes a short identifier for the given pages, used to name their Chroma collection.
+
+    Besides the page contents, the embedding model and the splitter settings are part of the
+    identifier, so changing either never reuses vectors or chunks built with the old ones.
+    """
+    splitter_tag = f"{SPLITTER_VERSION}:{CHUNK_SIZE}:{CHUNK_OVERLAP}"
+    digest = hashlib.sha256(f"{model_name}\0{splitter_tag}\0".encode())
+    for page in pages:
+        # Length prefix each page so different page splits of the same text hash differently
+        content = page.page_content.encode()
+        digest.update(f"{len(content)}:".encode())
+        digest.update(content)
+    return digest.hexdigest()[:16]
+
+
+def approximate_token_count(text):
+    """
+    Estimates the number of embedding model tokens in a text.
+
+    VertexAI does not ship an offline tokenizer for its embedding models, so this uses the
+    common rule of thumb of roughly four characters per token.
+    """
+    return (len(text) + 3) // 4
+
+
+def make_text_splitter():
+    """
+    Creates the splitter that turns pages into chunks of approximately CHUNK_SIZE embedding tokens.
+    """
+    return RecursiveCharacterTextSplitter(
+        separators=["\n\n", "\n", ". ", " ", ""],
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        length_function=approximate_token_count,
+    )
+
+
+def split_pages(pages):
+    """
+    Splits pages into text chunks.
+    :param pages: The Documents extracted from the uploaded PDFs.
+
+    Returns the chunks of all pages, in page order.
+
+    Splitting stays in-process: PyPDFLoader already yields pages of at most a few thousand characters,
+    so pickling them to worker processes costs more than the splitting itself.
+    """
+    return make_text_splitter().split_documents(pages)
+
+
+def normalize_rows(vectors):
+    """
+    Scales each row of a float32 matrix to unit length, so dot products become cosine similarities.
+    """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def quantize_rows(vectors):
+    """
+    Scalar quantizes each row of a float32 matrix to int8 with its own scale, using 4x less memory.
+    :param vectors: A float32 vector or matrix with one embedding per row.
+
+    Returns the int8 values and the float32 scales, such that vectors ~= values * scales / 127.
+    """
+    scales = np.max(np.abs(vectors), axis=-1, keepdims=True)
+    scales = np.where(scales == 0, 1, scales).astype(np.float32)
+    values = np.round(vectors * 127 / scales).astype(np.int8)
+    return values, scales
+
+
+def top_k_cosine(quantized, scales, query, k):
+    """
+    Finds the rows of a quantized, normalized embedding matrix most similar to a query vector.
+    :param quantized: An int8 matrix with one quantized unit length embedding per row.
+    :param scales: The float32 scale of each row of the quantized matrix.
+    :param query: The query embedding.
+    :param k: The number of matches to return.
+
+    Returns the row indices and approximate cosine similarity scores of the matches, best first.
+    """
+    query_values, query_scale = quantize_rows(
+        normalize_rows(np.asarray(query, dtype=np.float32)))
+    query_values = query_values.astype(np.float32)
+
+    # Products of int8 values are small enough for float32 to accumulate them without rounding
+    # at common embedding sizes, so blocks are scored through BLAS instead of integer matmul
+    scores = np.empty(len(quantized), dtype=np.float32)
+    for start in range(0, len(quantized), QUERY_BLOCK_ROWS):
+        block = quantized[start:start + QUERY_BLOCK_ROWS].astype(np.float32)
+        scores[start:start + QUERY_BLOCK_ROWS] = block @ query_values
+    scores *= scales[:, 0] * (query_scale[0] / (127 * 127))
+
+    k = min(k, len(scores))
+    # Partially sort to find the top k, then order only those k
+    indices = np.argpartition(-scores, k - 1)[:k]
+    indices = indices[np.argsort(-scores[indices])]
+    return indices, scores[indices]
+
 
 class ChromaCollectionCreator:
     def __init__(self, processor, embed_model):
@@ -20,8 +144,12 @@ class ChromaCollectionCreator:
         :param embeddings_config: An embedding client for embedding documents.
         """
         self.processor = processor      # This will hold the DocumentProcessor
-        self.embed_model = embed_model  # This will hold the EmbeddingClient
+        # This will hold the EmbeddingClient, wrapped so repeated chunks are served from the cache
+        self.embed_model = CachedEmbeddings(embed_model) if embed_model else None
         self.db = None                  # This will hold the Chroma collection
+        self._quantized = None          # Normalized int8 embeddings of the collection, one row per document
+        self._scales = None             # Scale of each row of self._quantized
+        self._ids = []                  # Chroma ids of the documents, in the same order as self._quantized
 
     def create_chroma_collection(self):
         """
@@ -30,44 +158,92 @@ class ChromaCollectionCreator:
         Steps:
         1. Check if any documents have been processed by the DocumentProcessor instance. If not, display an error message using streamlit's error widget.
 
-        2. Split the processed documents into text chunks suitable for embedding and indexing. Use the CharacterTextSplitter from Langchain to achieve this. You'll need to define a separator, chunk size, and chunk overlap.
+        2. Split the processed documents into text chunks suitable for embedding and indexing. Use the RecursiveCharacterTextSplitter from Langchain to achieve this. You'll need to define the separators, chunk size, chunk overlap, and a token based length function.
         https://python.langchain.com/docs/modules/data_connection/document_transformers/
 
-        3. Create a Chroma collection in memory with the text chunks obtained from step 2 and the embeddings model initialized in the class. Use the Chroma.from_documents method for this purpose.
+        3. Reuse the persisted Chroma collection for these documents if one was completely filled before. Otherwise create it with the text chunks obtained from step 2 and the embeddings model initialized in the class, embedding them up front in one call and adding the vectors to the persisted collection.
         https://python.langchain.com/docs/integrations/vectorstores/chroma#use-openai-embeddings
         https://docs.trychroma.com/getting-started
 
         Instructions:
         - Begin by verifying that there are processed pages available. If not, inform the user that no documents are found.
 
-        - If documents are available, proceed to split these documents into smaller text chunks. This operation prepares the documents for embedding and indexing. Look into using the CharacterTextSplitter with appropriate parameters (e.g., separator, chunk_size, chunk_overlap).
+        - If documents are available, look up the collection named after a hash of the page contents, embedding model and splitter settings in CHROMA_PERSIST_DIRECTORY, so the same documents are never re-split or re-embedded across sessions.
 
-        - Next, with the prepared texts, create a new Chroma collection. This step involves using the embeddings model (self.embed_model) along with the texts to initialize the collection.
+        - Only when it is missing or was not completely filled, split the documents into smaller text chunks. This operation prepares the documents for embedding and indexing. Look into using the RecursiveCharacterTextSplitter with appropriate parameters (e.g., separators, chunk_size, chunk_overlap, length_function). Then fill the collection from the prepared texts with the embeddings model (self.embed_model).
 
         - Finally, provide feedback to the user regarding the success or failure of the Chroma collection creation.
 
         Note: Ensure to replace placeholders like [Your code here] with actual implementation code as per the instructions above.
         """
 
+        # Any query index belongs to the previous collection
+        self._quantized = None
+        self._scales = None
+        self._ids = []
+
         # Check for processed documents
         if len(self.processor.pages) == 0:
             st.error("No documents found!", icon="🚨")
             return
 
-        # Split documents into text chunks
-        text_splitter = CharacterTextSplitter(
-            separator="\n",
-            chunk_size=1000,
-            chunk_overlap=100,
-        )
-        docs = text_splitter.split_documents(self.processor.pages)
-
-        # Validate docs and self.embed_model before creating Chroma collection
-        if docs and self.embed_model:
-            # Create Chroma collection
-            self.db = Chroma.from_documents(docs, self.embed_model)
+        # Validate self.embed_model before creating Chroma collection
+        if self.embed_model:
+            # Name the collection after the document contents, embedding model and splitter settings
+            # so unchanged PDFs hit the cache
+            collection_id = hash_pages(self.processor.pages, self.embed_model.model_name)
+            collection_name = f"quiz_{collection_id}"
+
+            # Reuse the persisted Chroma collection if these documents were embedded before
+            self.db = Chroma(
+                collection_name=collection_name,
+                persist_directory=CHROMA_PERSIST_DIRECTORY,
+                embedding_function=self.embed_model
+            )
+            # Only a collection marked complete is reused; a partially filled one (after an error, a crash
+            # or a concurrent ingest) is filled again, which overwrites its chunks under the same ids
+            collection_metadata = self.db._collection.metadata or {}
+            if not collection_metadata.get(COLLECTION_COMPLETE_KEY):
+                # Split documents into text chunks, measured in approximate embedding tokens
+                docs = split_pages(self.processor.pages)
+                if not docs:
+                    self.db = None
+                    st.error(
+                        "Error: Unable to create Chroma collection. Please ensure that docs and self.embed_model are valid and not empty.")
+                else:
+                    texts = [doc.page_content for doc in docs]
+                    metadatas = [doc.metadata for doc in docs]
+
+                    # Embed every chunk up front in one call; CachedEmbeddings sends repeated chunks
+                    # (e.g. headers and footers) to VertexAI only once
+                    embeddings = self._embed_texts(texts)
+                    if embeddings is None:
+                        self.db = None
+                    else:
+                        try:
+                            # Fill the Chroma collection with the precomputed embeddings, in batches
+                            # no larger than the Chroma client accepts
+                            for batch_ids, batch_embeddings, batch_metadatas, batch_texts in create_batches(
+                                    api=self.db._client,
+                                    ids=[f"{collection_id}-{i}" for i in range(len(texts))],
+                                    embeddings=embeddings,
+                                    metadatas=metadatas,
+                                    documents=texts):
+                                self.db._collection.upsert(
+                                    ids=batch_ids,
+                                    embeddings=batch_embeddings,
+                                    metadatas=batch_metadatas,
+                                    documents=batch_texts
+                                )
+
+                            # Mark the collection complete only after its last batch was written
+                            self.db._collection.modify(
+                                metadata={**collection_metadata, COLLECTION_COMPLETE_KEY: True})
+                        except Exception as e:
+                            print(f"An error occurred while filling the Chroma collection: {e}")
+                            self.db = None
         else:
-            # Display an error message using streamlit's error widget if docs or self.embed_model is empty
+            # Display an error message using streamlit's error widget if self.embed_model is empty
             st.error(
                 "Error: Unable to create Chroma collection. Please ensure that docs and self.embed_model are valid and not empty.")
 
@@ -76,17 +252,66 @@ class ChromaCollectionCreator:
         else:
             st.error("Failed to create Chroma Collection!", icon="🚨")
 
+    def _embed_texts(self, texts):
+        """
+        Embeds all texts with a single embed_documents call. VertexAIEmbeddings sizes the requests by
+        token count, sends them in parallel and retries rate limited ones itself.
+        :param texts: The texts to embed.
+
+        Returns the embeddings in the same order as the texts or None if the operation fails.
+        """
+        try:
+            return self.embed_model.embed_documents(texts)
+        except GoogleAPIError as e:
+            print(f"An error occurred while embedding the documents: {e}")
+            return None
+
+    def _load_query_index(self):
+        """
+        Loads the embeddings of the Chroma collection into one contiguous, normalized matrix quantized to int8,
+        so queries can be answered with a single matrix-vector product over a quarter of the memory of
+        float32 vectors. Only the ids of the documents are kept; their texts stay in Chroma.
+        Called on the first query, since the quiz flow only uses the retriever and never needs it.
+        """
+        # Read and quantize one page at a time, so a full float copy of the embeddings never exists
+        total = self.db._collection.count()
+        quantized, scales, ids = None, None, []
+        for offset in range(0, total, INDEX_LOAD_PAGE_SIZE):
+            page = self.db.get(limit=INDEX_LOAD_PAGE_SIZE, offset=offset, include=["embeddings"])
+            # Never read past the rows allocated from the count above
+            page_ids = page["ids"][:total - len(ids)]
+            if not page_ids:
+                break
+            page_quantized, page_scales = quantize_rows(
+                normalize_rows(np.asarray(page["embeddings"][:len(page_ids)], dtype=np.float32)))
+            if quantized is None:
+                quantized = np.empty((total, page_quantized.shape[1]), dtype=np.int8)
+                scales = np.empty((total, 1), dtype=np.float32)
+            quantized[len(ids):len(ids) + len(page_ids)] = page_quantized
+            scales[len(ids):len(ids) + len(page_ids)] = page_scales
+            ids.extend(page_ids)
+
+        if ids:
+            self._quantized, self._scales, self._ids = quantized[:len(ids)], scales[:len(ids)], ids
+
     def query_chroma_collection(self, query) -> Document:
         """
         Queries the created Chroma collection for documents similar to the query.
         :param query: The query string to search for in the Chroma collection.
 
-        Returns the first matching document from the collection with similarity score.
+        Returns the first matching document from the collection with its approximate cosine similarity score.
         """
         if self.db:
-            docs = self.db.similarity_search_with_relevance_scores(query)
-            if docs:
-                return docs[0]
+            if self._quantized is None:
+                self._load_query_index()
+            query_vector = self.embed_model.embed_query(query)
+            if query_vector is not None and self._quantized is not None:
+                indices, scores = top_k_cosine(self._quantized, self._scales, query_vector, 1)
+                # Only the matching document is read back from Chroma
+                match = self.db.get(ids=[self._ids[indices[0]]], include=["documents", "metadatas"])
+                document = Document(
+                    page_content=match["documents"][0], metadata=match["metadatas"][0] or {})
+                return document, float(scores[0])
             else:
                 st.error("No matching documents found!", icon="🚨")
         else:
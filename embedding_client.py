@@ -1,11 +1,18 @@
+import hashlib
+import json
 import os
+import sqlite3
 import streamlit as st
+from contextlib import closing
 from dotenv import load_dotenv
 from langchain_google_vertexai import VertexAIEmbeddings
 
 # Load environment variables from .env file
 load_dotenv()
 
+# SQLite file holding previously computed embeddings
+EMBEDDING_CACHE_PATH = ".embedding_cache.sqlite3"
+
 
 class EmbeddingClient:
     """
@@ -38,6 +45,7 @@ class EmbeddingClient:
         """
         Initialize the embedding client with a specific model, project, and location for Google VertexAI.
         """
+        self.model_name = model_name
         self.client = VertexAIEmbeddings(
             model_name=model_name,
             project=project,
@@ -72,6 +80,101 @@ class EmbeddingClient:
             return None
 
 
+class CachedEmbeddings:
+    """
+    Wraps an EmbeddingClient and stores every computed vector in a SQLite cache keyed by the SHA-256
+    of the text and the model name, so identical chunks are only sent to VertexAI once.
+    """
+
+    def __init__(self, embed_client, cache_path=EMBEDDING_CACHE_PATH):
+        """
+        :param embed_client: The EmbeddingClient used to embed texts missing from the cache.
+        :param cache_path: Path of the SQLite file used as the cache.
+        """
+        self.embed_client = embed_client
+        self.model_name = embed_client.model_name
+        self.cache_path = cache_path
+        with closing(sqlite3.connect(self.cache_path)) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "hash TEXT NOT NULL, model TEXT NOT NULL, vec TEXT NOT NULL, "
+                "PRIMARY KEY (hash, model))"
+            )
+
+    def _lookup(self, hashes, model):
+        """
+        Fetches the cached vectors for the given text hashes.
+
+        :return: A dictionary mapping each cached hash to its vector.
+        """
+        found = {}
+        with closing(sqlite3.connect(self.cache_path)) as conn:
+            for h in set(hashes):
+                row = conn.execute(
+                    "SELECT vec FROM cache WHERE hash=? AND model=?", (h, model)).fetchone()
+                if row:
+                    found[h] = json.loads(row[0])
+        return found
+
+    def _store(self, vectors, model):
+        """
+        Writes the given hash to vector mapping to the cache.
+        """
+        with closing(sqlite3.connect(self.cache_path)) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (hash, model, vec) VALUES (?, ?, ?)",
+                [(h, model, json.dumps(vec)) for h, vec in vectors.items()]
+            )
+
+    @staticmethod
+    def _hash(text):
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def embed_documents(self, documents):
+        """
+        Retrieve embeddings for multiple documents, only embedding the ones missing from the cache.
+
+        :param documents: A list of text documents to embed.
+        :return: A list of embeddings in the same order as the documents, or None if the operation fails.
+        """
+        hashes = [self._hash(text) for text in documents]
+        vectors = self._lookup(hashes, self.model_name)
+
+        # Embed every distinct missing text once, in a single call
+        misses = {}
+        for h, text in zip(hashes, documents):
+            if h not in vectors:
+                misses[h] = text
+        if misses:
+            embedded = self.embed_client.embed_documents(list(misses.values()))
+            if embedded is None:
+                return None
+            new_vectors = dict(zip(misses.keys(), embedded))
+            self._store(new_vectors, self.model_name)
+            vectors.update(new_vectors)
+
+        return [vectors[h] for h in hashes]
+
+    def embed_query(self, query):
+        """
+        Retrieve the embeddings for a query, using the cache when possible.
+
+        :param query: The text query to embed.
+        :return: The embeddings for the query or None if the operation fails.
+        """
+        # Queries may be embedded differently from documents, so they get their own cache key
+        model = f"{self.model_name}:query"
+        h = self._hash(query)
+        cached = self._lookup([h], model)
+        if h in cached:
+            return cached[h]
+
+        vector = self.embed_client.embed_query(query)
+        if vector is not None:
+            self._store({h: vector}, model)
+        return vector
+
+
 if __name__ == "__main__":
     model_name = os.getenv('MODEL_NAME'),
     project = os.getenv('GOOGLE_PROJECT_ID')
@@ -60,6 +60,9 @@ class QuizGenerator:
             
             Context: {context}
             """
+        # Use the system template to create a PromptTemplate
+        self.prompt = PromptTemplate.from_template(self.system_template)
+        self._chain = None  # Built lazily by _build_chain and reused for every question
 
     def init_llm(self):
         """
@@ -76,11 +79,10 @@ class QuizGenerator:
             max_output_tokens=500
         )
 
-    def generate_question_with_vectorstore(self):
+    def _build_chain(self):
         """
-        Generates a quiz question based on the topic provided using a vectorstore
-
-        :return: A JSON object representing the generated quiz question.
+        Composes the retrieval chain used to generate quiz questions and stores it in `self._chain`
+        so it is only built once.
         """
         if not self.llm:
             self.init_llm()
@@ -90,17 +92,23 @@ class QuizGenerator:
         # Enable a Retriever
         retriever = self.vectorstore.db.as_retriever()
 
-        # Use the system template to create a PromptTemplate
-        prompt = PromptTemplate.from_template(self.system_template)
-
         # RunnableParallel allows Retriever to get relevant documents
         # RunnablePassthrough allows chain.invoke to send self.topic to LLM
         setup_and_retrieval = RunnableParallel(
             {"context": retriever, "topic": RunnablePassthrough()}
         )
         # Create a chain with the Retriever, PromptTemplate, and LLM
-        chain = setup_and_retrieval | prompt | self.llm
+        self._chain = setup_and_retrieval | self.prompt | self.llm
+
+    def generate_question_with_vectorstore(self):
+        """
+        Generates a quiz question based on the topic provided using a vectorstore
+
+        :return: A JSON object representing the generated quiz question.
+        """
+        if self._chain is None:
+            self._build_chain()
 
         # Invoke the chain with the topic as input
-        response = chain.invoke(self.topic)
+        response = self._chain.invoke(self.topic)
         return response
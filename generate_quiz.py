@@ -1,19 +1,55 @@
-from langchain_core.runnables import RunnablePassthrough, RunnableParallel
 from langchain_google_vertexai import VertexAI
 from langchain_core.prompts import PromptTemplate
+from langchain_core.utils.json import parse_json_markdown
 from chroma_collection_creator import ChromaCollectionCreator
 from embedding_client import EmbeddingClient
 from document_processor import DocumentProcessor
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from typing import List
 import streamlit as st
 import os
 import sys
 import json
+import asyncio
 from dotenv import load_dotenv
 sys.path.append(os.path.abspath('../../'))
 
 
 load_dotenv()
 
+# Maximum number of LLM calls per requested question across the whole quiz
+MAX_ATTEMPTS_PER_QUESTION = 3
+
+# Initial delay in seconds before retrying a round that produced no new question
+RETRY_BACKOFF_SECONDS = 0.2
+
+
+class Choice(BaseModel):
+    """
+    A single multiple choice answer of a quiz question.
+    """
+    key: str = Field(description="The letter identifying the choice, e.g. A")
+    value: str = Field(description="The text of the choice")
+
+
+class Quiz(BaseModel):
+    """
+    The structured output expected from the LLM for a single quiz question.
+    """
+    question: str = Field(description="The quiz question")
+    choices: List[Choice] = Field(description="The 4 multiple choice answers to the question")
+    answer: str = Field(description="The key of the correct answer from the choices list")
+    explanation: str = Field(description="An explanation as to why the answer is correct")
+
+    @model_validator(mode="after")
+    def check_answer_in_choices(self):
+        """
+        Ensures the answer refers to one of the choices.
+        """
+        if self.answer not in {choice.key for choice in self.choices}:
+            raise ValueError(f"Answer {self.answer!r} is not one of the choice keys.")
+        return self
+
 
 class QuizGenerator:
     def __init__(self, topic=None, num_questions=1, vectorstore=None):
@@ -35,8 +71,18 @@ class QuizGenerator:
         self.num_questions = num_questions
 
         self.vectorstore = vectorstore
+        # Retrieve a small, diverse context (MMR) to keep prompts short
+        self.retriever = None
+        if vectorstore and vectorstore.db:
+            self.retriever = vectorstore.db.as_retriever(
+                search_type="mmr",
+                search_kwargs={"k": 2, "fetch_k": 8, "lambda_mult": 0.5}
+            )
+        self.context = None  # Retrieved context for the topic, shared by every question
         self.llm = None
+        self.max_concurrency = 5  # Maximum number of concurrent LLM calls
         self.question_bank = []  # Initialize the question bank to store questions
+        self._seen_questions = set()  # Question texts already in the bank, for O(1) duplicate checks
         self.system_template = """
             You are a subject matter expert on the topic: {topic}
             
@@ -61,6 +107,9 @@ class QuizGenerator:
             
             Context: {context}
             """
+        # Use the system template to create a PromptTemplate
+        self.prompt = PromptTemplate.from_template(self.system_template)
+        self._chain = None  # Built lazily by _build_chain and reused for every question
 
     def init_llm(self):
         """
@@ -80,85 +129,208 @@ class QuizGenerator:
         except Exception as e:
             print("Failed to initialize VertexAI:", e)
 
-    def generate_question_with_vectorstore(self):
+    def _build_chain(self):
         """
-        Generates a quiz question based on the topic provided using a vectorstore
-
-        :return: A JSON object representing the generated quiz question.
+        Composes the chain used to generate quiz questions from the topic and retrieved context,
+        and stores it in `self._chain` so it is only built once.
         """
-        self.init_llm()  # Assuming init_llm() initializes self.llm properly
+        if not self.llm:
+            self.init_llm()
         if not self.llm:
             raise Exception("Failed to initialize llm")
-        if not self.vectorstore:
-            raise ValueError("Vectorstore not provided.")
 
-        # Enable a Retriever
-        retriever = self.vectorstore.db.as_retriever()
-
-        # Use the system template to create a PromptTemplate
-        prompt = PromptTemplate.from_template(self.system_template)
-
-        # RunnableParallel allows Retriever to get relevant documents
-        # RunnablePassthrough allows chain.invoke to send self.topic to LLM
-        setup_and_retrieval = RunnableParallel(
-            {"context": retriever, "topic": RunnablePassthrough()}
-        )
-        if not setup_and_retrieval:
-            raise Exception("Failed to initialize the setup_and_retrieval")
-
-        # Create a chain with the Retriever, PromptTemplate, and LLM
-        chain = setup_and_retrieval | prompt | self.llm
-        if not chain:
+        # Create a chain with the PromptTemplate and LLM; its text output is parsed while streaming
+        self._chain = self.prompt | self.llm
+        if not self._chain:
             raise Exception("Failed to initialize the chain")
 
-        # Invoke the chain with the topic as input
-        response = chain.invoke(self.topic)
-        return response
+    def get_context(self):
+        """
+        Retrieves the documents related to the topic from the vectorstore. The search runs only once
+        and its result is reused for every question of the quiz.
+
+        :return: The page contents of the retrieved documents joined into a single string.
+        """
+        if self.context is None:
+            if not self.vectorstore:
+                raise ValueError("Vectorstore not provided.")
+            if not self.retriever:
+                raise ValueError("Vectorstore has no Chroma collection to retrieve from.")
+
+            docs = self.retriever.invoke(self.topic)
+            self.context = "\n\n".join(doc.page_content for doc in docs)
+        return self.context
+
+    def _is_streamed_duplicate(self, text) -> bool:
+        """
+        Checks whether a partially streamed question already exists in the question bank.
+
+        :param text: The LLM output streamed so far.
+        :return: True if the question text is complete and already in the question bank.
+        """
+        try:
+            partial = parse_json_markdown(text)
+        except json.JSONDecodeError:
+            return False
+
+        # The question text is complete once the model has moved on to the choices
+        if isinstance(partial, dict) and "choices" in partial and partial.get("question") in self._seen_questions:
+            print("Duplicate question detected while streaming.")
+            return True
+        return False
+
+    def _complete_question(self, text):
+        """
+        Parses the complete LLM output and checks that it is a quiz question matching the Quiz schema.
+        Unlike the partial parsing used while streaming, this rejects output that was cut off, e.g. by
+        max_output_tokens, so a truncated question never passes the schema check.
+
+        :param text: The full LLM output.
+        :return: The validated question dictionary, or None if it is not complete JSON matching the Quiz schema.
+        """
+        try:
+            question = parse_json_markdown(text, parser=json.loads)
+        except json.JSONDecodeError:
+            print("Failed to decode question JSON.")
+            return None
+
+        try:
+            return Quiz.model_validate(question).model_dump()
+        except ValidationError:
+            print("Generated question does not match the quiz schema.")
+            return None
+
+    def generate_question_with_vectorstore(self):
+        """
+        Generates a quiz question based on the topic provided using a vectorstore.
+
+        The LLM output is streamed and parsed incrementally, so a question that is already in the
+        question bank is rejected as soon as its text is complete instead of after the whole answer.
+
+        :return: A dictionary representing the generated quiz question, or None if it was a duplicate or incomplete.
+        """
+        if self._chain is None:
+            self._build_chain()
+
+        # Stream the chain with the topic and the retrieved context as input
+        text = ""
+        for chunk in self._chain.stream({"topic": self.topic, "context": self.get_context()}):
+            text += chunk
+            if self._is_streamed_duplicate(text):
+                return None
+        return self._complete_question(text)
+
+    async def generate_question_with_vectorstore_async(self):
+        """
+        Asynchronous version of `generate_question_with_vectorstore`, so several questions can be generated concurrently.
+
+        :return: A dictionary representing the generated quiz question, or None if it was a duplicate or incomplete.
+        """
+        if self._chain is None:
+            self._build_chain()
+
+        # Stream the chain with the topic and the retrieved context as input
+        text = ""
+        async for chunk in self._chain.astream({"topic": self.topic, "context": self.get_context()}):
+            text += chunk
+            if self._is_streamed_duplicate(text):
+                return None
+        return self._complete_question(text)
+
+    async def generate_quiz_async(self) -> list:
+        """
+        Generates the quiz by running the LLM calls concurrently.
+
+        Twice as many questions as are missing are requested at once, since some of them are expected to be
+        duplicates. Questions are validated as soon as they finish, so the streams still running can reject
+        duplicates of them early, and the remaining calls are cancelled once the quiz is complete.
+
+        :return: A list of dictionaries, where each dictionary represents a unique quiz question.
+        """
+        # Build the shared chain and retrieve the context once, before the concurrent calls use them
+        if self._chain is None:
+            self._build_chain()
+        self.get_context()
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        failed_calls = 0
+
+        async def generate_limited():
+            nonlocal failed_calls
+            async with semaphore:
+                try:
+                    return await self.generate_question_with_vectorstore_async()
+                except Exception as e:
+                    # A failed call (e.g. a blocked candidate or an API error) only costs its own attempt
+                    print(f"Failed to generate question: {e}")
+                    failed_calls += 1
+                    return None
+
+        # Cap the LLM calls for the whole quiz so failures or duplicates cannot run up latency and cost
+        attempts_remaining = self.num_questions * MAX_ATTEMPTS_PER_QUESTION
+        backoff = 0
+        while len(self.question_bank) < self.num_questions and attempts_remaining > 0:
+            missing = self.num_questions - len(self.question_bank)
+
+            # Oversample so duplicates rarely force another round
+            count = min(2 * missing, attempts_remaining)
+            attempts_remaining -= count
+            added = 0
+            failed_calls = 0
+
+            tasks = [asyncio.ensure_future(generate_limited()) for _ in range(count)]
+            try:
+                for next_question in asyncio.as_completed(tasks):
+                    question = await next_question
+
+                    # Validate the question using the validate_question method
+                    if question and self.validate_question(question):
+                        print("Successfully generated unique question")
+                        # Add the valid and unique question to the bank
+                        self.question_bank.append(question)
+                        self._seen_questions.add(question['question'])
+                        added += 1
+                        if len(self.question_bank) >= self.num_questions:
+                            break
+                    else:
+                        print("Duplicate or invalid question detected.")
+            finally:
+                # Stop the calls that are no longer needed
+                for task in tasks:
+                    task.cancel()
+
+            if added and not failed_calls:
+                backoff = 0
+            elif attempts_remaining > 0 and len(self.question_bank) < self.num_questions:
+                # Back off exponentially while rounds keep failing or calls keep raising
+                await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** backoff)
+                backoff += 1
+
+        if len(self.question_bank) < self.num_questions:
+            print(f"Generated only {len(self.question_bank)} of {self.num_questions} questions.")
+        return self.question_bank
 
     def generate_quiz(self) -> list:
         """
         Task: Generate a list of unique quiz questions based on the specified topic and number of questions.
 
-        This method orchestrates the quiz generation process by utilizing the `generate_question_with_vectorstore` method to generate each question and the `validate_question` method to ensure its uniqueness before adding it to the quiz.
+        This method orchestrates the quiz generation process by running `generate_quiz_async`, which generates the questions concurrently with `generate_question_with_vectorstore_async` and uses the `validate_question` method to ensure their uniqueness before adding them to the quiz.
 
         Steps:
-            1. Initialize an empty list to store the unique quiz questions.
-            2. Loop through the desired number of questions (`num_questions`), generating each question via `generate_question_with_vectorstore`.
-            3. For each generated question, validate its uniqueness using `validate_question`.
-            4. If the question is unique, add it to the quiz; if not, attempt to generate a new question (consider implementing a retry limit).
+            1. Request twice the number of missing questions from the LLM concurrently.
+            2. Validate the uniqueness of each decoded question using `validate_question` as soon as it is generated.
+            3. If the question is unique, add it to the quiz, and stop the remaining calls once the quiz is complete.
+            4. If questions are still missing because of invalid JSON or duplicates, start another round for the remainder, backing off exponentially after rounds without a new question or with failed calls, until MAX_ATTEMPTS_PER_QUESTION calls per question have been spent.
             5. Return the compiled list of unique quiz questions.
 
         Returns:
         - A list of dictionaries, where each dictionary represents a unique quiz question generated based on the topic.
 
-        Note: This method relies on `generate_question_with_vectorstore` for question generation and `validate_question` for ensuring question uniqueness. Ensure `question_bank` is properly initialized and managed.
+        Note: This method relies on `generate_question_with_vectorstore_async` for question generation and `validate_question` for ensuring question uniqueness. Ensure `question_bank` is properly initialized and managed.
         """
         # self.question_bank = [] # Reset the question bank
 
-        for _ in range(self.num_questions):
-            # Try maximum 10 times when the json string could not be converted to a dictionary.
-            for _ in range(0, 10):
-                # Use class method to generate question
-                question_str = self.generate_question_with_vectorstore()
-
-                try:
-                    # Convert the JSON String to a dictionary
-                    question = json.loads(question_str)
-
-                except json.JSONDecodeError:
-                    print("Failed to decode question JSON.")
-                    continue  # Skip this iteration if JSON decoding fails
-
-                # Validate the question using the validate_question method
-                if question and self.validate_question(question):
-                    print("Successfully generated unique question")
-                    # Add the valid and unique question to the bank
-                    self.question_bank.append(question)
-                    break
-                else:
-                    print("Duplicate or invalid question detected.")
-                    continue
-        return self.question_bank
+        return asyncio.run(self.generate_quiz_async())
 
     def validate_question(self, question: dict) -> bool:
         """
@@ -168,7 +340,7 @@ class QuizGenerator:
 
         Steps:
             1. Extract the question text from the provided dictionary.
-            2. Iterate over the existing questions in `question_bank` and compare their texts to the current question's text.
+            2. Look the text up in `_seen_questions`, the set of question texts already stored in `question_bank`.
             3. If a duplicate is found, return False to indicate the question is not unique.
             4. If no duplicates are found, return True, indicating the question is unique and can be added to the quiz.
 
@@ -178,16 +350,10 @@ class QuizGenerator:
         Returns:
         - A boolean value: True if the question is unique, False otherwise.
 
-        Note: This method assumes `question` is a valid dictionary and `question_bank` has been properly initialized.
+        Note: This method assumes `question` is a valid dictionary and `_seen_questions` is kept in sync with `question_bank`.
         """
 
-        is_unique = True
         question_text = question['question']
-        if not question_text:
-            is_unique = False
-        else:
-            for dictionary in self.question_bank:
-                if dictionary['question'] == question_text:
-                    is_unique = False
-        # is_unique = any(question in self.question_bank for item in self.question_bank)
-        return is_unique
+        if not question_text or question_text in self._seen_questions:
+            return False
+        return True
@@ -1,6 +1,6 @@
 from quiz_manager import QuizManager
 from generate_quiz import QuizGenerator
-from chroma_collection_creator import ChromaCollectionCreator
+from chroma_collection_creator import ChromaCollectionCreator, hash_pages
 from embedding_client import EmbeddingClient
 from document_processor import DocumentProcessor
 import streamlit as st
@@ -11,6 +11,33 @@ sys.path.append(os.path.abspath('../../'))
 
 load_dotenv()
 
+
+@st.cache_resource
+def get_embed_client(model_name, project, location):
+    """
+    Returns an EmbeddingClient shared across Streamlit reruns, so VertexAI is only set up once.
+    """
+    return EmbeddingClient(model_name, project, location)
+
+
+@st.cache_resource
+def get_chroma_collection(pages_hash, _processor, _embed_client):
+    """
+    Returns a ChromaCollectionCreator with its collection created, shared across Streamlit reruns
+    for as long as the uploaded documents and embedding model (identified by pages_hash) do not change.
+    Raises a ValueError when the collection could not be created.
+    """
+    chroma_creator = ChromaCollectionCreator(_processor, _embed_client)
+    chroma_creator.create_chroma_collection()
+    if chroma_creator.db is None:
+        # st.cache_resource does not cache exceptions, so the next attempt builds the collection again
+        raise ValueError("Failed to create Chroma Collection.")
+
+    # The pages are only needed to build the collection, do not keep this session's processor alive
+    chroma_creator.processor = None
+    return chroma_creator
+
+
 if __name__ == "__main__":
 
     embed_config = {
@@ -37,10 +64,7 @@ if __name__ == "__main__":
             # Create a new st.form flow control for Data Ingestion
             with st.form("Load Data to Chroma"):
 
-                embed_client = EmbeddingClient(**embed_config)
-
-                chroma_creator = ChromaCollectionCreator(
-                    processor, embed_client)
+                embed_client = get_embed_client(**embed_config)
 
                 topic = st.text_input(
                     "Topic for Generative Quiz", placeholder="Enter the topic of the document")
@@ -50,7 +74,12 @@ if __name__ == "__main__":
                 submitted = st.form_submit_button("Generate")
 
                 if submitted:
-                    chroma_creator.create_chroma_collection()
+                    try:
+                        chroma_creator = get_chroma_collection(
+                            hash_pages(processor.pages, embed_client.model_name), processor, embed_client)
+                    except ValueError:
+                        # create_chroma_collection has already shown the error
+                        st.stop()
 
                     if len(processor.pages) > 0:
                         st.write(
@@ -60,16 +89,34 @@ if __name__ == "__main__":
                     generator = QuizGenerator(
                         topic, num_questions, chroma_creator)
                     question_bank = generator.generate_quiz()
-                    st.session_state['question_bank'] = question_bank
-                    st.session_state['display_quiz'] = True
-                    screen.empty()
-                    st.session_state['question_index'] = 0
+
+                    # Format the choices once, so reruns of the quiz screen do not rebuild them
+                    for question in question_bank:
+                        question['_rendered_choices'] = [
+                            f"{choice['key']}) {choice['value']}" for choice in question['choices']]
+
+                    if len(question_bank) == 0:
+                        # Stay on the builder screen, the quiz screen needs at least one question
+                        st.error(
+                            "Failed to generate any questions. Please try again.", icon="🚨")
+                    else:
+                        # Tell the user on the quiz screen when fewer questions could be generated
+                        st.session_state['quiz_warning'] = None
+                        if len(question_bank) < num_questions:
+                            st.session_state['quiz_warning'] = (
+                                f"Only {len(question_bank)} of {num_questions} questions could be generated.")
+                        st.session_state['question_bank'] = question_bank
+                        st.session_state['display_quiz'] = True
+                        screen.empty()
+                        st.session_state['question_index'] = 0
 
     if st.session_state.get("display_quiz"):
 
         st.empty()
         with st.container():
             st.header("Generated Quiz Question: ")
+            if st.session_state.get('quiz_warning'):
+                st.warning(st.session_state['quiz_warning'])
             quiz_manager = QuizManager(st.session_state['question_bank'])
 
             # Format the question and display it
@@ -79,12 +126,8 @@ if __name__ == "__main__":
                 index_question = quiz_manager.get_question_at_index(
                     st.session_state['question_index'])
 
-                # Unpack choices for radio button
-                choices = []
-                for choice in index_question['choices']:
-                    key = choice['key']
-                    value = choice['value']
-                    choices.append(f"{key}) {value}")
+                # Choices for the radio button, formatted when the quiz was generated
+                choices = index_question['_rendered_choices']
 
                 # Display the Question
                 st.write(